@@ -2,6 +2,7 @@ from config.config import *
 from extraction_utils import *
 import argparse
 from datetime import datetime
+from functools import partial
 from os.path import exists
 from nilearn import image
 from nilearn.maskers import NiftiMapsMasker
@@ -24,11 +25,94 @@ args = CLI.parse_args()
 n_mris = args.n_mris
 data_directory = args.output_directory
 
+def get_inverse_brainnetome(patient, base_mri):
+    """
+    put the Brainnetome atlas into the patient's space with FSL, only when this file doesn't already exist
+    :param patient: patient ID, the current directory is the patient's func folder
+    :param base_mri: file name of the patient's MRI
+    :return: file name of the atlas in patient space
+    """
+    ## Then we name the files we will create with FSL
+    patient_inverse_warp_field = os.path.join(data_directory, patient + '_ses-2_task-rest_mni2func-warp.nii.gz')
+    inverse_brainnetome = os.path.join(data_directory, patient + '_ses-2_task-rest_inverse_brainnetome.nii.gz')
+
+    ##using FSL command line, inverse a warp and apply it to the brainnetome atlas
+    if not exists(inverse_brainnetome):
+        inv_warp_command = 'fsl5.0-invwarp --ref=' + patient + '_ses-2_task-rest_filtered-clean.nii.gz --warp=' + \
+                           patient + '_ses-2_task-rest_func2mni-warp.nii.gz --out=' + patient_inverse_warp_field
+        os.system(inv_warp_command)
+        apply_inv_command = 'fsl5.0-applywarp --ref=' + base_mri + ' --in=' + brainnetome_file + \
+                            ' --out=' + inverse_brainnetome + '  --warp=' + patient_inverse_warp_field
+        os.system(apply_inv_command)
+    return (inverse_brainnetome)
+
+
+def get_volume_features(patient, base_mri):
+    """
+    :return: dictionary of the probabilistic volume features of the Brainnetome regions in the patient's space
+    """
+    ##Now we load the inverse with SITK so we can manipulate a numpy array from it
+    inverse_brainnetome_sitk = sitk.GetArrayFromImage(sitk.ReadImage(get_inverse_brainnetome(patient, base_mri)))
+
+    ## Add the probabilistic volume of each region, calculate the size of gyri and lobes
+    regions['vol'] = np.sum(inverse_brainnetome_sitk, axis=(1, 2, 3))
+    gyri_vol = regions[['Gyrus', 'vol']].groupby('Gyrus').sum()
+    gyri_vol['percent_vol'] = (gyri_vol['vol'] / gyri_vol['vol'].sum()) * 100
+    lobe_vol = regions[['Lobe', 'vol']].groupby('Lobe').sum()
+    lobe_vol['percent_vol'] = (lobe_vol['vol'] / lobe_vol['vol'].sum()) * 100
+
+    volume_features = {}
+    volume_features['Total Probabilistic Voxel Volume In Target Regions'] = np.sum(regions['vol'])
+    volume_features['Total Probabalistic Voxel Volume Proportional To Atlas Volume'] = \
+        np.sum(regions['vol']) / np.sum(brainnetome_lobe_vol['vol'])
+    volume_features.update(region_feature_extraction(gyri_vol, brainnetome_gyri_vol))
+    volume_features.update(region_feature_extraction(lobe_vol, brainnetome_lobe_vol))
+    return (volume_features)
+
+
+def get_atlas_sources(patient, base_mri, brain):
+    """
+    :return: list of (source, time series, labels) for the Brainnetome subregions and their gyri and lobes
+    """
+    ## The subregion time series are saved next to the feature groups, so only a change of precision extracts them again
+    time_series_file = os.path.join(data_directory, 'feature_dicts/' + patient + '_ses-2_task-rest_region_time_series.npz')
+    time_series = load_region_time_series(time_series_file, precision)
+    if time_series is None:
+        ##Extract a time series from the loaded brain based on the inverse brainnetome atlas
+        masker = NiftiMapsMasker(maps_img=get_inverse_brainnetome(patient, base_mri), standardize=True,
+                                 dtype=masker_dtype)
+        time_series = masker.fit_transform(brain)
+
+        ## Keep the time series as a contiguous array (one row per subregion)
+        time_series = np.ascontiguousarray(time_series.T, dtype=precision)
+        save_region_time_series(time_series_file, time_series, precision)
+
+    ## Aggregate with the region+subregion groupings which are held separately as labels
+    gyri_labels, gyri_time_series = aggregate_time_series(time_series, regions['Gyrus'], precision)
+    lobe_labels, lobe_time_series = aggregate_time_series(time_series, regions['Lobe'], precision)
+    subregion_labels = ['Subregion ' + str(number) for number in regions['Number']]
+    return ([('Brainnetome Gyri', gyri_time_series, gyri_labels),
+             ('Brainnetome Lobe', lobe_time_series, lobe_labels),
+             ('Brainnetome Subregion', time_series, subregion_labels)])
+
+
 folders = [os.path.join(bids, folder) for folder in os.listdir(bids) if os.path.isdir(os.path.join(bids, folder))]
 files_visited = 0
 folders_without_necessary_files = 0
 feature_extraction_failures = 0
 failed_extraction_ids = []
+
+## Every feature group is stored with a fingerprint of the parameters that produced it, so a rerun with a changed config
+## only extracts the groups that are missing or stale
+fingerprints = {'Brainnetome Volume': get_fingerprint({})}
+fingerprints.update(get_feature_group_fingerprints('Brainnetome Gyri', THRESHOLDS, return_graph_features, False, precision))
+fingerprints.update(get_feature_group_fingerprints('Brainnetome Lobe', THRESHOLDS, return_graph_features,
+                                                   return_correlations, precision))
+if return_subregion_graph_features:
+    fingerprints.update(get_feature_group_fingerprints('Brainnetome Subregion', THRESHOLDS, True, False, precision))
+fingerprints.update(get_feature_group_fingerprints('ICA', THRESHOLDS, True, return_correlations, precision,
+                                                   valid_ica_regions))
+
 for folder in folders:
     # try to enter folder and load data - skip folders with no data or unloadable data
     try:
@@ -40,72 +124,27 @@ for folder in folders:
         ica_time_series_file = patient + '_ses-2_task-rest_ts-ica-25.txt'
         base_mri = patient + '_ses-2_task-rest_filtered-clean.nii.gz'
         features_file = os.path.join(data_directory,'feature_dicts/' + patient + '_ses-2_task-rest_network_features.json')
-        if not exists(features_file):
-            brain = image.load_img(base_mri)
+        feature_groups_file = os.path.join(data_directory, 'feature_dicts/' + patient + '_ses-2_task-rest_feature_groups.json')
+        brain = image.load_img(base_mri)
     except:
         folders_without_necessary_files += 1
         new_cwd = False
-    if new_cwd and exists(ica_time_series_file) and not exists(features_file):
-        now = datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        if verbose == True:
-            print('on mri # ' + str(files_visited) + ' patient ' + str(patient))
-            print("Current Time =", current_time)
-
-        ## Then we name the files we will create with FSL
-        patient_inverse_warp_field = os.path.join(data_directory, patient + '_ses-2_task-rest_mni2func-warp.nii.gz')
-        inverse_brainnetome = os.path.join(data_directory, patient + '_ses-2_task-rest_inverse_brainnetome.nii.gz')
-
-        ##using FSL command line, inverse a warp and apply it to the brainnetome atlas, only when this file doesn't already exist
-        if not exists(inverse_brainnetome):
-            inv_warp_command = 'fsl5.0-invwarp --ref=' + patient + '_ses-2_task-rest_filtered-clean.nii.gz --warp=' + \
-                               patient + '_ses-2_task-rest_func2mni-warp.nii.gz --out=' + patient_inverse_warp_field
-            os.system(inv_warp_command)
-            apply_inv_command = 'fsl5.0-applywarp --ref=' + base_mri + ' --in=' + brainnetome_file + \
-                                ' --out=' + inverse_brainnetome + '  --warp=' + patient_inverse_warp_field
-            os.system(apply_inv_command)
-
-        ##Now we load the inverse we just made with SITK so we can manipulate a numpy array from it
-        inverse_brainnetome_sitk = sitk.GetArrayFromImage(sitk.ReadImage(inverse_brainnetome))
-
-        ##Extract a time series from the loaded brain based on the inverse brainnetome atlas
-        masker = NiftiMapsMasker(maps_img=inverse_brainnetome, standardize=True)
-        time_series = masker.fit_transform(brain)
-
-        ## Add the probabilistic volume of each region, calculate the size of gyri and lobes
-        regions['vol'] = np.sum(inverse_brainnetome_sitk, axis=(1, 2, 3))
-        gyri_vol = regions[['Gyrus', 'vol']].groupby('Gyrus').sum()
-        gyri_vol['percent_vol'] = (gyri_vol['vol'] / gyri_vol['vol'].sum()) * 100
-        lobe_vol = regions[['Lobe', 'vol']].groupby('Lobe').sum()
-        lobe_vol['percent_vol'] = (lobe_vol['vol'] / lobe_vol['vol'].sum()) * 100
-
-        ## Put the time series together with the region+subregion groupings and aggregate
-        labeled_time_series = pd.concat([regions, pd.DataFrame(time_series.T)], axis=1)
-        gyri_time_series = labeled_time_series.drop(columns=['Lobe', 'Number', 'vol'])
-        gyri_time_series = gyri_time_series.groupby(['Gyrus']).mean()
-        lobe_time_series = labeled_time_series.drop(columns=['Gyrus', 'Number', 'vol'])
-        lobe_time_series = lobe_time_series.groupby(['Lobe']).mean()
-
-        ## Collect features
+    if new_cwd and exists(ica_time_series_file):
+        ## Collect features, only for missing or stale groups - the FSL projection and time series extraction are the
+        ## slow part of extraction, so they only run when a Brainnetome group needs them
         try:
-            features = {}
-            features['Total Probabilistic Voxel Volume In Target Regions'] = np.sum(regions['vol'])
-            features['Total Probabalistic Voxel Volume Proportional To Atlas Volume'] = \
-                np.sum(regions['vol']) / np.sum(brainnetome_lobe_vol['vol'])
-            ica_features = ICA_graph_feature_extraction(ica_time_series_file, THRESHOLDS, valid_ica_regions, return_correlations)
-            gyri_time_series_features = atlas_time_series_feature_extraction(gyri_time_series, THRESHOLDS, \
-                                                                                False, False)
-            lobe_time_series_features = atlas_time_series_feature_extraction(lobe_time_series, THRESHOLDS, \
-                                                                                return_graph_features, return_correlations)
-            gyri_volume_features = region_feature_extraction(gyri_vol, brainnetome_gyri_vol)
-            lobe_volume_features = region_feature_extraction(lobe_vol, brainnetome_lobe_vol)
-            for sub_features in [gyri_time_series_features, lobe_time_series_features, gyri_volume_features, \
-                                    lobe_volume_features, ica_features]:
-                features.update(sub_features)
-            ## Write features to output
-            with open(features_file, 'w') as data:
-                data.write(str(features))
-            files_visited += 1
+            stale_groups = update_feature_groups(feature_groups_file, features_file, fingerprints, THRESHOLDS,
+                                                 ica_time_series_file, valid_ica_regions,
+                                                 partial(get_atlas_sources, patient, base_mri, brain),
+                                                 partial(get_volume_features, patient, base_mri), precision)
+            if stale_groups:
+                if verbose == True:
+                    now = datetime.now()
+                    current_time = now.strftime("%H:%M:%S")
+                    print('on mri # ' + str(files_visited) + ' patient ' + str(patient))
+                    print("Current Time =", current_time)
+                    print('extracted feature groups: ' + str(list(stale_groups)))
+                files_visited += 1
         except:
             feature_extraction_failures += 1
             failed_extraction_ids.append(patient)
@@ -40,3 +40,16 @@ return_correlations = False
 
 # Return graph features for volume extraction
 return_graph_features = False
+
+# Return signal variance and graph features for the full graph of all 246 Brainnetome subregions. Node connectivity and
+# the small-world coefficients are estimated on a graph this size, see the readme
+return_subregion_graph_features = False
+
+# Numeric precision ('float64' or 'float32') of region signals and correlation matrices from the masker through to graph
+# thresholding. 'float32' halves memory and bandwidth; correlations then agree with 'float64' to within 1e-5 (absolute)
+# and signal variances to within 1e-5 (relative), so graph features only differ when a correlation lies within 1e-5 of a
+# threshold
+precision = 'float64'
+# nilearn converts the whole 4D image to the masker dtype, so only float32 is asked for - in float64 mode the image keeps
+# its own dtype and is not up-cast before extraction
+masker_dtype = 'float32' if precision == 'float32' else None
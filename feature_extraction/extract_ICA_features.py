@@ -31,7 +31,7 @@ if not exists(ica_time_series_file):
         errno.ENOENT, os.strerror(errno.ENOENT), ica_time_series_file)
 features = {}
 try:
-    ica_features = ICA_graph_feature_extraction(ica_time_series_file, THRESHOLDS, valid_ica_regions, get_correlations)
+    ica_features = ICA_graph_feature_extraction(ica_time_series_file, THRESHOLDS, valid_ica_regions, get_correlations, precision)
     with open(features_file, 'w') as data:
         data.write(str(ica_features))
 except:
@@ -4,28 +4,30 @@ from config.config import *
 import argparse
 import numpy as np
 from extraction_utils import ICA_graph_feature_extraction, get_correlation_features, \
-    graph_from_corr_matrix, get_graph_statistics
+    graph_from_corr_matrix, get_graph_statistics, correlation_matrix
 
 
-def graph_feature_extraction(ica_file, thresholds, valid_regions = [], add_correlation_features=False):
+def graph_feature_extraction(ica_file, thresholds, valid_regions = [], add_correlation_features=False,
+                             precision='float64'):
     """
     take a CSV delimited time series and extract graph features
     :param ica_file: a space delimited file of signals from each ICA region, an example is provided in utilities
     :param thresholds: list of float, necessarily between 0 and 1
     :param valid_regions: list of int
     :param add_correlation_features: Boolean - since correlations are already calculated one can add correlations between regions as a feature
+    :param precision: numpy dtype name, 'float64' or 'float32', used for signals and correlations
     :return: dictionary of features
     """
     features = {}
     df = pd.read_csv(ica_file, header=None, engine='python')
-    ts_df = df.T
-    for index, row in ts_df.iterrows():
+    # one row per region, one column per time point
+    time_series = np.ascontiguousarray(df.to_numpy(dtype=precision).T)
+    for index, variance in enumerate(np.var(time_series, axis=1)):
         var_str = str('Region ' + str(index) + ' Signal Variance')
-        features[var_str] = np.var(row)
-    corr = df.corr()
+        features[var_str] = variance
+    corr = correlation_matrix(time_series, precision)
     if add_correlation_features:
         features = get_correlation_features(corr, features, "Regions: ")
-    corr = corr.to_numpy()
     for threshold in thresholds:
         graph = graph_from_corr_matrix(corr, threshold, valid_regions)
         statistics = get_graph_statistics(graph)
@@ -61,7 +63,7 @@ if not exists(time_series_file):
         errno.ENOENT, os.strerror(errno.ENOENT), time_series_file)
 features = {}
 try:
-    ica_features = graph_feature_extraction(time_series_file, THRESHOLDS, valid_ica_regions, get_correlations)
+    ica_features = graph_feature_extraction(time_series_file, THRESHOLDS, valid_ica_regions, get_correlations, precision)
     with open(features_file, 'w') as data:
         data.write(str(ica_features))
 except:
@@ -4,7 +4,8 @@ import argparse
 from nilearn import image
 from nilearn.maskers import NiftiMapsMasker
 import SimpleITK as sitk
-from extraction_utils import region_feature_extraction, atlas_time_series_feature_extraction
+from extraction_utils import region_feature_extraction, atlas_time_series_feature_extraction, \
+    aggregate_time_series
 
 CLI = argparse.ArgumentParser()
 CLI.add_argument(
@@ -27,6 +28,11 @@ CLI.add_argument(
     type=bool,
     default=return_graph_features,
 )
+CLI.add_argument(
+    "--get_subregion_graph_features",
+    type=bool,
+    default=return_subregion_graph_features,
+)
 CLI.add_argument(
     "--brainnetome_in_patient_space",
     type=str,
@@ -37,10 +43,11 @@ base_mri = args.patient_MRI
 features_file = args.output_file
 get_correlations = args.get_correlations
 get_graph_features = args.get_graph_features
+get_subregion_graph_features = args.get_subregion_graph_features
 brain = image.load_img(base_mri)
 inverse_brainnetome = args.brainnetome_in_patient_space
 inverse_brainnetome_sitk = sitk.GetArrayFromImage(sitk.ReadImage(inverse_brainnetome))
-masker = NiftiMapsMasker(maps_img=inverse_brainnetome, standardize=True)
+masker = NiftiMapsMasker(maps_img=inverse_brainnetome, standardize=True, dtype=masker_dtype)
 time_series = masker.fit_transform(brain)
 
 ## Add the probabilistic volume of each region, calculate the size of gyri and lobes
@@ -50,12 +57,12 @@ gyri_vol['percent_vol'] = (gyri_vol['vol'] / gyri_vol['vol'].sum()) * 100
 lobe_vol = regions[['Lobe', 'vol']].groupby('Lobe').sum()
 lobe_vol['percent_vol'] = (lobe_vol['vol'] / lobe_vol['vol'].sum()) * 100
 
-## Put the time series together with the region+subregion groupings and aggregate
-labeled_time_series = pd.concat([regions, pd.DataFrame(time_series.T)], axis=1)
-gyri_time_series = labeled_time_series.drop(columns=['Lobe', 'Number', 'vol'])
-gyri_time_series = gyri_time_series.groupby(['Gyrus']).mean()
-lobe_time_series = labeled_time_series.drop(columns=['Gyrus', 'Number', 'vol'])
-lobe_time_series = lobe_time_series.groupby(['Lobe']).mean()
+## Keep the time series as a contiguous array (one row per subregion), aggregated with the region+subregion groupings
+## which are held separately as labels
+time_series = np.ascontiguousarray(time_series.T, dtype=precision)
+gyri_labels, gyri_time_series = aggregate_time_series(time_series, regions['Gyrus'], precision)
+lobe_labels, lobe_time_series = aggregate_time_series(time_series, regions['Lobe'], precision)
+subregion_labels = ['Subregion ' + str(number) for number in regions['Number']]
 
 ## Collect features
 features = {}
@@ -63,14 +70,20 @@ try:
     features['Total Probabilistic Voxel Volume In Target Regions'] = np.sum(regions['vol'])
     features['Total Probabalistic Voxel Volume Proportional To Atlas Volume'] = \
         np.sum(regions['vol']) / np.sum(brainnetome_lobe_vol['vol'])
-    gyri_time_series_features = atlas_time_series_feature_extraction(gyri_time_series, THRESHOLDS, \
-                                                                     get_graph_features, get_correlations)
-    lobe_time_series_features = atlas_time_series_feature_extraction(lobe_time_series, THRESHOLDS, \
-                                                                     get_graph_features, get_correlations)
+    gyri_time_series_features = atlas_time_series_feature_extraction(gyri_time_series, gyri_labels, THRESHOLDS, \
+                                                                     get_graph_features, get_correlations, precision)
+    lobe_time_series_features = atlas_time_series_feature_extraction(lobe_time_series, lobe_labels, THRESHOLDS, \
+                                                                     get_graph_features, get_correlations, precision, \
+                                                                     'Brainnetome Lobe')
+    subregion_time_series_features = {}
+    if get_subregion_graph_features:
+        subregion_time_series_features = atlas_time_series_feature_extraction(time_series, subregion_labels, THRESHOLDS, \
+                                                                              True, False, precision, \
+                                                                              'Brainnetome Subregion')
     gyri_volume_features = region_feature_extraction(gyri_vol, brainnetome_gyri_vol)
     lobe_volume_features = region_feature_extraction(lobe_vol, brainnetome_lobe_vol)
-    for sub_features in [gyri_time_series_features, lobe_time_series_features, gyri_volume_features, \
-                         lobe_volume_features]:
+    for sub_features in [gyri_time_series_features, lobe_time_series_features, subregion_time_series_features, \
+                         gyri_volume_features, lobe_volume_features]:
         features.update(sub_features)
     ## Write features
     with open(features_file, 'w') as data:
@@ -1,6 +1,23 @@
+import hashlib
+import io
+import json
+import os
 import pandas as pd
 import networkx as nx
 import numpy as np
+from networkx.algorithms.approximation import local_node_connectivity
+
+# Graphs with more nodes than this (i.e. the 246 Brainnetome subregions) estimate node connectivity and the small-world
+# coefficients instead of computing them exactly, since the exact networkx versions take minutes per graph at that size.
+# The choice is made for the whole graph, before it is split into subgraphs
+MAX_EXACT_GRAPH_NODES = 64
+
+# Number of node pairs sampled to estimate average node connectivity on graphs above MAX_EXACT_GRAPH_NODES. Each pair
+# costs about one path search per unit of mean degree, so denser graphs sample fewer pairs, keeping the path searches to
+# about NODE_CONNECTIVITY_PATH_SEARCHES - their connectivity also varies less from pair to pair
+NODE_CONNECTIVITY_SAMPLES = 1000
+MIN_NODE_CONNECTIVITY_SAMPLES = 100
+NODE_CONNECTIVITY_PATH_SEARCHES = 20000
 
 
 def graph_from_corr_matrix(corr_matrix, threshold, valid_regions):
@@ -11,21 +28,45 @@ def graph_from_corr_matrix(corr_matrix, threshold, valid_regions):
     :param valid_regions: a list of valid regions, pertinent to ICA where some ICA regions are unhelpful
     :return: networkx graph "g"
     """
-    corr = pd.DataFrame(corr_matrix)
-    # Transform it in a links data frame (3 columns only):
-    links = corr.stack().reset_index()
-    links.columns = ['var1', 'var2', 'value']
-
-    # Keep only correlation over a threshold and remove self correlation (cor(A,A)=1)
-    links_filtered = links.loc[(np.abs(links['value']) > threshold) & (links['var1'] != links['var2'])]
+    # Keep only correlation over a threshold and remove self correlation (cor(A,A)=1), reading the upper triangle only
+    # since the matrix is symmetric
+    edges = np.triu(np.abs(corr_matrix) > threshold, k=1)
+    var1, var2 = np.nonzero(edges)
 
     # Build the graph
-    g = nx.from_pandas_edgelist(links_filtered, 'var1', 'var2')
-    g.add_nodes_from(range(0, len(corr)))
+    g = nx.Graph()
+    g.add_edges_from(zip(var1.tolist(), var2.tolist()))
+    g.add_nodes_from(range(0, len(corr_matrix)))
     g = remove_unwanted_ica_regions(valid_regions, g)
     return (g)
 
 
+def correlation_matrix(time_series, precision='float64'):
+    """
+    correlate the signals of every pair of regions, keeping the matrix a contiguous numpy array of the chosen precision
+    :param time_series: numpy array with one row per region and one column per time point
+    :param precision: numpy dtype name, 'float64' or 'float32'
+    :return: numpy correlation matrix
+    """
+    time_series = np.asarray(time_series, dtype=precision)
+    return (np.ascontiguousarray(np.corrcoef(time_series, dtype=precision)))
+
+
+def aggregate_time_series(time_series, groups, precision='float64'):
+    """
+    average subregion signals into the groups they belong to (gyri or lobes), keeping labels apart from the signals
+    :param time_series: numpy array with one row per subregion and one column per time point
+    :param groups: list-like of group labels, one per subregion row
+    :param precision: numpy dtype name, 'float64' or 'float32'
+    :return: sorted list of group labels, and a numpy array with one row of averaged signal per label
+    """
+    labels, inverse, counts = np.unique(np.asarray(groups), return_inverse=True, return_counts=True)
+    membership = (inverse.ravel() == np.arange(len(labels))[:, None]).astype(precision)
+    membership /= counts[:, None].astype(precision)
+    grouped = membership @ np.asarray(time_series, dtype=precision)
+    return (labels.tolist(), np.ascontiguousarray(grouped))
+
+
 def remove_unwanted_ica_regions(ica_valid_regions, graph):
     """
     ica from UK biobank stipulates that some ica regions are invalid, so this function makes it possible to remove them
@@ -76,38 +117,204 @@ def get_density(graph):
     return 2 * len(graph.edges) / (n_nodes * (n_nodes - 1))
 
 
-def get_small_world_features(graph, features, normalization_term=1):
+def get_shortest_path_lengths(adjacency):
+    """
+    all-pairs shortest path lengths (in edges) of a graph, by a breadth first search from every node at once - each step
+    expands all frontiers with one product of the sparse adjacency matrix, so dense graphs cost no more than sparse ones
+    :param adjacency: scipy sparse adjacency matrix, symmetric
+    :return: numpy matrix of path lengths, inf where nodes are not connected
+    """
+    n_nodes = adjacency.shape[0]
+    path_lengths = np.full((n_nodes, n_nodes), np.inf)
+    np.fill_diagonal(path_lengths, 0)
+    reached = np.eye(n_nodes, dtype=bool)
+    frontier = reached
+    step = 0
+    while frontier.any():
+        step += 1
+        frontier = (np.asarray(adjacency @ frontier.astype(np.float64)) > 0) & ~reached
+        path_lengths[frontier] = step
+        reached |= frontier
+    return (path_lengths)
+
+
+def get_global_efficiency(path_lengths):
+    """
+    average inverse shortest path length over all pairs of nodes, equivalent to networkx global_efficiency
+    :param path_lengths: numpy matrix of path lengths from get_shortest_path_lengths
+    :return: float
+    """
+    n_nodes = len(path_lengths)
+    if n_nodes < 2:
+        return (0)
+    with np.errstate(divide='ignore'):
+        inverse_lengths = 1 / path_lengths
+    np.fill_diagonal(inverse_lengths, 0)
+    return (inverse_lengths.sum() / (n_nodes * (n_nodes - 1)))
+
+
+def get_local_efficiency(adjacency):
+    """
+    average global efficiency of the subgraphs made by each node's neighbours, equivalent to networkx local_efficiency
+    :param adjacency: scipy sparse adjacency matrix in csr format
+    :return: float
+    """
+    efficiencies = []
+    for node in range(adjacency.shape[0]):
+        neighbours = adjacency.indices[adjacency.indptr[node]:adjacency.indptr[node + 1]]
+        neighbourhood = adjacency[neighbours][:, neighbours]
+        efficiencies.append(get_global_efficiency(get_shortest_path_lengths(neighbourhood)))
+    return (np.mean(efficiencies))
+
+
+def get_average_shortest_path_length(path_lengths):
+    """
+    average shortest path length of a connected graph, equivalent to networkx average_shortest_path_length
+    :param path_lengths: numpy matrix of path lengths from get_shortest_path_lengths
+    :return: float
+    """
+    n_nodes = len(path_lengths)
+    if n_nodes < 2:
+        return (0)
+    return (path_lengths.sum() / (n_nodes * (n_nodes - 1)))
+
+
+def get_triangles_and_degrees(adjacency):
+    """
+    count the triangles through each node from the sparse adjacency matrix, as diag(A^3) / 2
+    :param adjacency: scipy sparse adjacency matrix
+    :return: numpy array of triangles per node, numpy array of degree per node
+    """
+    triangles = np.asarray(adjacency.dot(adjacency).multiply(adjacency).sum(axis=1)).ravel() / 2
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    return (triangles, degrees)
+
+
+def get_average_clustering(triangles, degrees):
     """
-    add all graph statistics to the features dictionary, mostly using the networkx package to calculate staistics
+    average clustering coefficient, equivalent to networkx average_clustering
+    :param triangles: numpy array of triangles per node
+    :param degrees: numpy array of degree per node
+    :return: float
+    """
+    possible_triangles = degrees * (degrees - 1) / 2
+    clustering = np.divide(triangles, possible_triangles, out=np.zeros(len(triangles)), where=possible_triangles > 0)
+    return (np.mean(clustering))
+
+
+def get_transitivity(triangles, degrees):
+    """
+    fraction of connected triples that close into triangles, equivalent to networkx transitivity
+    :param triangles: numpy array of triangles per node
+    :param degrees: numpy array of degree per node
+    :return: float
+    """
+    if triangles.sum() == 0:
+        return (0)
+    return (triangles.sum() / (degrees * (degrees - 1) / 2).sum())
+
+
+def get_sampled_node_connectivity(graph, n_samples=None, seed=0):
+    """
+    estimate average node connectivity from a fixed random sample of node pairs, using the White and Newman
+    approximation of node independent paths for each pair
+    :param graph: networkx graph
+    :param n_samples: number of node pairs to sample, by default scaled down with the mean degree of the graph
+    :param seed: int, so that the same graph always gets the same estimate
+    :return: float
+    """
+    # subgraph views are slow to search, so walk a copy of the graph
+    graph = nx.Graph(graph)
+    nodes = list(graph.nodes)
+    if n_samples is None:
+        mean_degree = 2 * len(graph.edges) / len(nodes)
+        n_samples = int(np.clip(NODE_CONNECTIVITY_PATH_SEARCHES / mean_degree, MIN_NODE_CONNECTIVITY_SAMPLES,
+                                NODE_CONNECTIVITY_SAMPLES))
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, len(nodes), n_samples)
+    # offset each target from its source so no pair is a node with itself
+    targets = (sources + rng.integers(1, len(nodes), n_samples)) % len(nodes)
+    return (np.mean([local_node_connectivity(graph, nodes[source], nodes[target])
+                     for source, target in zip(sources, targets)]))
+
+
+def get_reference_small_world_features(graph, features, transitivity, clustering, path_length, normalization_term=1):
+    """
+    add sigma and omega using analytic random and lattice references with the same number of nodes and mean degree,
+    in place of the reference graphs networkx generates
     :param graph: networkx graph
     :param features: dictionary of features
+    :param transitivity: transitivity of the graph
+    :param clustering: average clustering of the graph
+    :param path_length: average shortest path length of the graph
     :param normalization_term: a float or int used to weight how much a subraph contributes to the feature score
     :return: features dictionary
     """
-    # For sigma and omega, networkx generates random equivalent graphs that can have zero-denominator statistics
-    try:
-        sigma = nx.sigma(graph)
-        if not isinstance(sigma, (int, float)):
-            features['Sigma'] += sigma * normalization_term
-        else:
-            features['Sigma Zero Denominator'] += normalization_term
-    except:
+    n_nodes = len(graph.nodes)
+    mean_degree = 2 * len(graph.edges) / n_nodes
+    # random graph: clustering k / (n - 1) and path length ln(n) / ln(k), lattice: clustering 3(k - 2) / 4(k - 1)
+    if mean_degree > 1:
+        random_clustering = mean_degree / (n_nodes - 1)
+        random_path_length = np.log(n_nodes) / np.log(mean_degree)
+        features['Sigma'] += (transitivity / random_clustering) / (path_length / random_path_length) * normalization_term
+    else:
         features['Sigma Zero Denominator'] += normalization_term
-    try:
-        omega = nx.omega(graph)
-        if not isinstance(omega, (int, float)):
-            features['Omega'] += omega * normalization_term
-        else:
-            features['Omega Zero Denominator'] += normalization_term
-    except:
+    if mean_degree > 2:
+        random_path_length = np.log(n_nodes) / np.log(mean_degree)
+        lattice_clustering = 3 * (mean_degree - 2) / (4 * (mean_degree - 1))
+        features['Omega'] += (random_path_length / path_length - clustering / lattice_clustering) * normalization_term
+    else:
         features['Omega Zero Denominator'] += normalization_term
-    features['Local Efficiency'] += nx.local_efficiency(graph) * normalization_term
-    features['Global Efficiency'] += nx.global_efficiency(graph) * normalization_term
-    features['Average Shortest Path Length'] += nx.average_shortest_path_length(graph) * normalization_term
-    features['Average Node Connectivity'] += nx.average_node_connectivity(graph) * normalization_term
+    return (features)
+
+
+def get_small_world_features(graph, features, normalization_term=1, estimate=False):
+    """
+    add all graph statistics to the features dictionary, computed from the graph's sparse adjacency matrix so they scale
+    to the full Brainnetome subregion graph
+    :param graph: networkx graph
+    :param features: dictionary of features
+    :param normalization_term: a float or int used to weight how much a subraph contributes to the feature score
+    :param estimate: Bool: if True, estimate node connectivity and the small-world coefficients, see use_estimates
+    :return: features dictionary
+    """
+    adjacency = nx.to_scipy_sparse_array(graph, format='csr', dtype=np.float64)
+    path_lengths = get_shortest_path_lengths(adjacency)
+    triangles, degrees = get_triangles_and_degrees(adjacency)
+    transitivity = get_transitivity(triangles, degrees)
+    clustering = get_average_clustering(triangles, degrees)
+    path_length = get_average_shortest_path_length(path_lengths)
+    if estimate:
+        features = get_reference_small_world_features(graph, features, transitivity, clustering, path_length,
+                                                      normalization_term)
+        node_connectivity = get_sampled_node_connectivity(graph)
+    else:
+        # For sigma and omega, networkx generates random equivalent graphs that can have zero-denominator statistics,
+        # which come back as inf or nan
+        try:
+            sigma = nx.sigma(graph)
+            if np.isfinite(sigma):
+                features['Sigma'] += sigma * normalization_term
+            else:
+                features['Sigma Zero Denominator'] += normalization_term
+        except:
+            features['Sigma Zero Denominator'] += normalization_term
+        try:
+            omega = nx.omega(graph)
+            if np.isfinite(omega):
+                features['Omega'] += omega * normalization_term
+            else:
+                features['Omega Zero Denominator'] += normalization_term
+        except:
+            features['Omega Zero Denominator'] += normalization_term
+        node_connectivity = nx.average_node_connectivity(graph)
+    features['Local Efficiency'] += get_local_efficiency(adjacency) * normalization_term
+    features['Global Efficiency'] += get_global_efficiency(path_lengths) * normalization_term
+    features['Average Shortest Path Length'] += path_length * normalization_term
+    features['Average Node Connectivity'] += node_connectivity * normalization_term
     features['Density'] += get_density(graph) * normalization_term
-    features['Average Clustering'] += nx.average_clustering(graph) * normalization_term
-    features['Transitivity'] += nx.transitivity(graph) * normalization_term
+    features['Average Clustering'] += clustering * normalization_term
+    features['Transitivity'] += transitivity * normalization_term
     return (features)
 
 
@@ -122,6 +329,16 @@ def tally_graph_fragment(subgraph, features):
     return (features)
 
 
+def use_estimates(graph):
+    """
+    decide once per graph whether node connectivity and the small-world coefficients are estimated, so every subgraph of
+    a large graph uses the same (fast) estimators, however small the subgraph
+    :param graph: networkx graph, before it is split into subgraphs
+    :return: Bool
+    """
+    return (len(graph.nodes) > MAX_EXACT_GRAPH_NODES)
+
+
 def get_graph_statistics(graph):
     """
     Calculate features from a graph
@@ -129,22 +346,24 @@ def get_graph_statistics(graph):
     :return: dictionary of features
     """
     features = instantiate_graph_features()
+    estimate = use_estimates(graph)
     if nx.is_connected(graph):
         features['Non-isolated Nodes'] = len(graph.nodes)
-        return (get_small_world_features(graph, features))
+        return (get_small_world_features(graph, features, estimate=estimate))
     else:
         subgraphs = get_subgraphs(graph)
         features['Subgraphs'] = len(subgraphs)
         features['Non-isolated Nodes'] = sum(len(subgraph.nodes) for subgraph in subgraphs \
                                              if len(subgraph.nodes) > 3)
-        return (get_statistics_from_subgraph_set(subgraphs, features))
+        return (get_statistics_from_subgraph_set(subgraphs, features, estimate))
 
 
-def get_statistics_from_subgraph_set(subgraphs, features):
+def get_statistics_from_subgraph_set(subgraphs, features, estimate=False):
     """
     Because many graphs have discontinuities, they need to be broken apart and statistics are summed up from each subgraph
     :param subgraphs: List of networkx graphs
     :param features: feature dictionary
+    :param estimate: Bool: if True, estimate node connectivity and the small-world coefficients, see use_estimates
     :return: feature dictionary
     """
     for i, subgraph in enumerate(subgraphs):
@@ -153,31 +372,33 @@ def get_statistics_from_subgraph_set(subgraphs, features):
         else:
             # smaller subgraphs get weighted less for the overall statistic, so we need a weighting term
             subgraph_normalization_term = len(subgraph.nodes) / features['Non-isolated Nodes']
-            get_small_world_features(subgraph, features, subgraph_normalization_term)
+            get_small_world_features(subgraph, features, subgraph_normalization_term, estimate)
     return (features)
 
 
-def ICA_graph_feature_extraction(ica_file, thresholds, valid_regions, add_correlation_features=False):
+def ICA_graph_feature_extraction(ica_file, thresholds, valid_regions, add_correlation_features=False,
+                                 precision='float64'):
     """
     take an ICA file from UKBiobank and return a dictionary of features from this file
     :param ica_file: a space delimited file of signals from each ICA region, an example is provided in utilities
     :param thresholds: list of float, necessarily between 0 and 1
     :param valid_regions: list of int
     :param add_correlation_features: Boolean - since correlations are already calculated one can add correlations between regions as a feature
+    :param precision: numpy dtype name, 'float64' or 'float32', used for signals and correlations
     :return: dictionary of features
     """
     features = {}
     df = pd.read_csv(ica_file, sep="  ", header=None, engine='python')
+    # one row per region, one column per time point
+    time_series = np.ascontiguousarray(df.to_numpy(dtype=precision).T)
     #Add signal variances as features as well
-    ts_df = df.T
-    for index, row in ts_df.iterrows():
+    for index, variance in enumerate(np.var(time_series, axis=1)):
         var_str = str('ICA region ' + str(index) + ' Signal Variance')
-        features[var_str] = np.var(row)
+        features[var_str] = variance
     # Now calculate correlations to generate a graph with
-    corr = df.corr()
+    corr = correlation_matrix(time_series, precision)
     if add_correlation_features:
         features = get_correlation_features(corr, features, "ICA Regions: ")
-    corr = corr.to_numpy()
     for threshold in thresholds:
         graph = graph_from_corr_matrix(corr, threshold, valid_regions)
         statistics = get_graph_statistics(graph)
@@ -187,33 +408,37 @@ def ICA_graph_feature_extraction(ica_file, thresholds, valid_regions, add_correl
     return (features)
 
 
-def atlas_time_series_feature_extraction(time_series_df, thresholds=[], add_network_features=False,
-                                         add_correlation_features=False):
+def atlas_time_series_feature_extraction(time_series, labels, thresholds=[], add_network_features=False,
+                                         add_correlation_features=False, precision='float64',
+                                         graph_prefix='Brainnetome Gyri'):
     """
     Function that calculates signal variance of regions of the brain as extracted from brainnetome labeled areas
-    :param time_series_df: pandas dataframe with indices as brain region labels and columns that make a signal
+    :param time_series: numpy array with one row per brain region and columns that make a signal
+    :param labels: list of brain region labels, one per row of time_series
     :param thresholds: thresholds with which to make a graph from correlation matrix
     :param add_network_features: Bool: if True, will calculate network features from the graph made by the correlation matrix and given thresholds
     :param add_correlation_features: Bool
+    :param precision: numpy dtype name, 'float64' or 'float32', used for signals and correlations
+    :param graph_prefix: string naming the organizational level of the regions in the graph feature keys
     :return: a dictionary of features
     """
     features = {}
-    for index, row in time_series_df.iterrows():
-        var_str = str(index.strip() + ' Signal Variance')
-        features[var_str] = np.var(row)
+    time_series = np.asarray(time_series, dtype=precision)
+    for label, variance in zip(labels, np.var(time_series, axis=1)):
+        var_str = str(label.strip() + ' Signal Variance')
+        features[var_str] = variance
     if add_network_features or add_correlation_features:
-        corr = time_series_df.transpose().corr()
+        corr = correlation_matrix(time_series, precision)
     if add_correlation_features:
-        features = get_correlation_features(corr, features)
+        features = get_correlation_features(corr, features, labels=labels)
     if add_network_features:
-        corr = corr.to_numpy()
         # all regions are valid for this
         valid_regions = list(np.arange(len(corr)))
         for threshold in thresholds:
             graph = graph_from_corr_matrix(corr, threshold, valid_regions)
             statistics = get_graph_statistics(graph)
             for k, v in statistics.items():
-                new_key = 'Brainnetome Gyri ' + k + ' at Threshold ' + str(threshold)
+                new_key = graph_prefix + ' ' + k + ' at Threshold ' + str(threshold)
                 features[new_key] = v
     return (features)
 
@@ -236,22 +461,222 @@ def region_feature_extraction(inv_vol, brainnetome_vol):
         features[relative_str] = inv_vol.loc[index]['percent_vol'] / brainnetome_vol.loc[index]['percent_vol']
     return (features)
 
-def get_correlation_features(corr_df, feature_dict, prefix=''):
+def get_correlation_features(corr, feature_dict, prefix='', labels=None):
     """
     Function to put correlations (already computed) into the feature return.
-    in this function instead of a correlation numpy array , we have to pass a correlation pandas dataframe to preserve the names of the rows
-    :param corr_df: pandas dataframe
+    the correlation is a numpy array, so the names of the rows are passed separately as labels
+    :param corr: numpy correlation matrix
     :param feature_dict: existing dictionary of features for an MRI, the correlations are loaded into this
     :param prefix: this string is optional,
+    :param labels: optional list of region names for the rows of corr, defaults to the row numbers
     :return: return the expanded feature dictionary.
     """
-    # remove redundant and diagonal entries from the correlation
-    corr = corr_df.where(np.invert(np.triu(np.ones(corr_df.shape)).astype(np.bool)))
-    # stack dataframe into one pandas.Series for easier iterations
-    corr = corr.stack()
-    # add each correlation into the dictionary of features
-    for index, value in corr.items():
-      key = "Correlation " + prefix + str(index[0]) + " vs " + str(index[1])
+    if labels is None:
+        labels = list(range(len(corr)))
+    # remove redundant and diagonal entries from the correlation, keeping the lower triangle row by row
+    rows, columns = np.tril_indices(len(corr), k=-1)
+    values = corr[rows, columns]
+    # add each correlation into the dictionary of features, skipping undefined correlations of flat signals
+    for row, column, value in zip(rows, columns, values):
+      if np.isnan(value):
+        continue
+      key = "Correlation " + prefix + str(labels[row]) + " vs " + str(labels[column])
       key = key.strip()
       feature_dict[key] = value
     return (feature_dict)
+
+
+def get_fingerprint(parameters):
+    """
+    hash the parameters that produce a feature group, so a rerun can tell whether the stored group is stale
+    :param parameters: dictionary of json serializable parameters
+    :return: string
+    """
+    return (hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest())
+
+
+def get_feature_group_fingerprints(source, thresholds, add_network_features=True, add_correlation_features=False,
+                                   precision='float64', valid_regions=[]):
+    """
+    fingerprint every feature group extracted from one source of signals - signal variance, correlations and the graph
+    features at each threshold are stored as separate groups so each can be recomputed on its own
+    :param source: string naming the source, the same as the prefix of its graph feature keys (i.e. 'ICA', 'Brainnetome Gyri')
+    :param thresholds: list of float
+    :param add_network_features: Bool
+    :param add_correlation_features: Bool
+    :param precision: numpy dtype name, 'float64' or 'float32'
+    :param valid_regions: list of int, only used for ICA
+    :return: dictionary of feature group names to fingerprints
+    """
+    fingerprints = {source + ' Signal Variance': get_fingerprint({'precision': precision})}
+    if add_correlation_features:
+        fingerprints[source + ' Correlations'] = get_fingerprint({'precision': precision})
+    if add_network_features:
+        for threshold in thresholds:
+            parameters = {'threshold': threshold, 'precision': precision,
+                          'valid_regions': [int(region) for region in valid_regions],
+                          'max_exact_graph_nodes': MAX_EXACT_GRAPH_NODES,
+                          'node_connectivity_samples': [NODE_CONNECTIVITY_SAMPLES, MIN_NODE_CONNECTIVITY_SAMPLES,
+                                                        NODE_CONNECTIVITY_PATH_SEARCHES]}
+            fingerprints[source + ' Graph at Threshold ' + str(threshold)] = get_fingerprint(parameters)
+    return (fingerprints)
+
+
+def get_stale_feature_groups(feature_groups, fingerprints):
+    """
+    find the feature groups that are missing, or were stored with a different fingerprint than the current parameters give
+    :param feature_groups: dictionary of stored feature groups, see load_feature_groups
+    :param fingerprints: dictionary of feature group names to current fingerprints
+    :return: dictionary of stale feature group names to current fingerprints
+    """
+    return ({name: fingerprint for name, fingerprint in fingerprints.items()
+             if name not in feature_groups or feature_groups[name]['fingerprint'] != fingerprint})
+
+
+def get_stale_thresholds(stale_groups, source, thresholds):
+    """
+    :param stale_groups: dictionary of stale feature group names to fingerprints
+    :param source: string naming the source of signals
+    :param thresholds: list of float
+    :return: the thresholds whose graph features from this source need to be recomputed
+    """
+    return ([threshold for threshold in thresholds if source + ' Graph at Threshold ' + str(threshold) in stale_groups])
+
+
+def split_feature_groups(features, source, fingerprints):
+    """
+    sort freshly extracted features into their feature groups, keeping only the groups that were asked for
+    :param features: dictionary of features extracted from one source of signals
+    :param source: string naming the source of signals
+    :param fingerprints: dictionary of the feature group names to keep and the fingerprints to store them with, groups of
+    other sources are ignored so their stored features are not overwritten
+    :return: dictionary of feature groups
+    """
+    feature_groups = {name: {'fingerprint': fingerprint, 'features': {}} for name, fingerprint in fingerprints.items()
+                      if name.startswith(source + ' ')}
+    for key, value in features.items():
+        if key.startswith('Correlation'):
+            name = source + ' Correlations'
+        elif ' at Threshold ' in key:
+            name = source + ' Graph at Threshold ' + key.rsplit(' at Threshold ', 1)[1]
+        else:
+            name = source + ' Signal Variance'
+        if name in feature_groups:
+            feature_groups[name]['features'][key] = value
+    return (feature_groups)
+
+
+def update_feature_groups(feature_groups_file, features_file, fingerprints, thresholds, ica_file=None,
+                          valid_ica_regions=[], get_atlas_sources=None, get_volume_features=None, precision='float64'):
+    """
+    bring one patient's features up to date with the config - load the stored feature groups, extract only the missing
+    or stale ones, drop the groups the config no longer asks for, then save the groups and the merged features
+    :param feature_groups_file: json file of the patient's feature groups
+    :param features_file: file the patient's merged features are written to
+    :param fingerprints: dictionary of every feature group name the config asks for to its fingerprint
+    :param thresholds: list of float
+    :param ica_file: the patient's ICA time series, for the 'ICA' groups
+    :param valid_ica_regions: list of int
+    :param get_atlas_sources: function returning a list of (source, time series, labels) for the Brainnetome levels,
+    only called when one of their groups is stale
+    :param get_volume_features: function returning a dictionary of volume features, only called when the
+    'Brainnetome Volume' group is stale
+    :param precision: numpy dtype name, 'float64' or 'float32'
+    :return: dictionary of the stale feature groups that were extracted, empty if the patient was already up to date
+    """
+    feature_groups = load_feature_groups(feature_groups_file)
+    stale_groups = get_stale_feature_groups(feature_groups, fingerprints)
+    if not stale_groups and feature_groups.keys() == fingerprints.keys() and os.path.exists(features_file):
+        return ({})
+    if 'Brainnetome Volume' in stale_groups:
+        feature_groups['Brainnetome Volume'] = {'fingerprint': stale_groups['Brainnetome Volume'],
+                                                'features': get_volume_features()}
+    if any(name.startswith('Brainnetome ') and name != 'Brainnetome Volume' for name in stale_groups):
+        for source, time_series, labels in get_atlas_sources():
+            if any(name.startswith(source + ' ') for name in stale_groups):
+                stale_thresholds = get_stale_thresholds(stale_groups, source, thresholds)
+                source_features = atlas_time_series_feature_extraction(time_series, labels, stale_thresholds,
+                                                                       len(stale_thresholds) > 0,
+                                                                       source + ' Correlations' in stale_groups,
+                                                                       precision, source)
+                feature_groups.update(split_feature_groups(source_features, source, stale_groups))
+    if any(name.startswith('ICA ') for name in stale_groups):
+        ica_features = ICA_graph_feature_extraction(ica_file, get_stale_thresholds(stale_groups, 'ICA', thresholds),
+                                                    valid_ica_regions, 'ICA Correlations' in stale_groups, precision)
+        feature_groups.update(split_feature_groups(ica_features, 'ICA', stale_groups))
+    # drop the groups the config no longer asks for, the features file is written first so an interrupted run leaves
+    # the old feature groups file in place and its groups are extracted again
+    feature_groups = {name: feature_groups[name] for name in fingerprints}
+    write_file_atomically(features_file, str(merge_feature_groups(feature_groups)))
+    save_feature_groups(feature_groups_file, feature_groups)
+    return (stale_groups)
+
+
+def merge_feature_groups(feature_groups):
+    """
+    :param feature_groups: dictionary of feature groups
+    :return: one dictionary of all features in the groups
+    """
+    features = {}
+    for feature_group in feature_groups.values():
+        features.update(feature_group['features'])
+    return (features)
+
+
+def load_feature_groups(feature_groups_file):
+    """
+    :param feature_groups_file: json file of feature groups written by save_feature_groups
+    :return: dictionary of feature group names to their fingerprint and features, empty if nothing was stored yet
+    """
+    if not os.path.exists(feature_groups_file):
+        return ({})
+    with open(feature_groups_file) as data:
+        return (json.load(data))
+
+
+def save_feature_groups(feature_groups_file, feature_groups):
+    """
+    :param feature_groups_file: json file to write to
+    :param feature_groups: dictionary of feature group names to their fingerprint and features
+    """
+    # numpy scalars (i.e. float32 features) are not json serializable, so they are written as floats
+    write_file_atomically(feature_groups_file, json.dumps(feature_groups, default=float))
+
+
+def load_region_time_series(time_series_file, precision='float64'):
+    """
+    :param time_series_file: npz file written by save_region_time_series
+    :param precision: numpy dtype name, 'float64' or 'float32'
+    :return: the stored array of region time series (regions x timepoints), or None if nothing was stored yet or it was
+    stored at a different precision
+    """
+    if not os.path.exists(time_series_file):
+        return (None)
+    with np.load(time_series_file) as data:
+        if str(data['fingerprint']) != get_fingerprint({'precision': precision}):
+            return (None)
+        return (np.ascontiguousarray(data['time_series'], dtype=precision))
+
+
+def save_region_time_series(time_series_file, time_series, precision='float64'):
+    """
+    :param time_series_file: npz file to write to
+    :param time_series: array of region time series (regions x timepoints)
+    :param precision: numpy dtype name the time series were extracted at
+    """
+    data = io.BytesIO()
+    np.savez(data, time_series=time_series, fingerprint=get_fingerprint({'precision': precision}))
+    write_file_atomically(time_series_file, data.getvalue())
+
+
+def write_file_atomically(file, contents):
+    """
+    write to a temporary file next to the target, then move it into place, so an interrupted run never leaves a half
+    written file behind
+    :param file: file to write to
+    :param contents: string, or bytes for a binary file
+    """
+    temporary_file = file + '.tmp'
+    with open(temporary_file, 'wb' if isinstance(contents, bytes) else 'w') as data:
+        data.write(contents)
+    os.replace(temporary_file, file)
@@ -49,7 +49,7 @@ if not exists(inverse_brainnetome):
 inverse_brainnetome_sitk = sitk.GetArrayFromImage(sitk.ReadImage(inverse_brainnetome))
 
 ##Extract a time series from the loaded brain based on the inverse brainnetome atlas
-masker = NiftiMapsMasker(maps_img=inverse_brainnetome, standardize=True)
+masker = NiftiMapsMasker(maps_img=inverse_brainnetome, standardize=True, dtype=masker_dtype)
 time_series = masker.fit_transform(brain)
 
 ## Add the probabilistic volume of each region, calculate the size of gyri and lobes
@@ -59,12 +59,12 @@ gyri_vol['percent_vol'] = (gyri_vol['vol'] / gyri_vol['vol'].sum()) * 100
 lobe_vol = regions[['Lobe', 'vol']].groupby('Lobe').sum()
 lobe_vol['percent_vol'] = (lobe_vol['vol'] / lobe_vol['vol'].sum()) * 100
 
-## Put the time series together with the region+subregion groupings and aggregate
-labeled_time_series = pd.concat([regions, pd.DataFrame(time_series.T)], axis=1)
-gyri_time_series = labeled_time_series.drop(columns=['Lobe', 'Number', 'vol'])
-gyri_time_series = gyri_time_series.groupby(['Gyrus']).mean()
-lobe_time_series = labeled_time_series.drop(columns=['Gyrus', 'Number', 'vol'])
-lobe_time_series = lobe_time_series.groupby(['Lobe']).mean()
+## Keep the time series as a contiguous array (one row per subregion), aggregated with the region+subregion groupings
+## which are held separately as labels
+time_series = np.ascontiguousarray(time_series.T, dtype=precision)
+gyri_labels, gyri_time_series = aggregate_time_series(time_series, regions['Gyrus'], precision)
+lobe_labels, lobe_time_series = aggregate_time_series(time_series, regions['Lobe'], precision)
+subregion_labels = ['Subregion ' + str(number) for number in regions['Number']]
 
 ## Collect features
 features = {}
@@ -72,15 +72,21 @@ try:
     features['Total Probabilistic Voxel Volume In Target Regions'] = np.sum(regions['vol'])
     features['Total Probabalistic Voxel Volume Proportional To Atlas Volume'] = \
         np.sum(regions['vol']) / np.sum(brainnetome_lobe_vol['vol'])
-    gyri_time_series_features = atlas_time_series_feature_extraction(gyri_time_series, THRESHOLDS, \
-                                                                     return_graph_features, return_correlations)
-    lobe_time_series_features = atlas_time_series_feature_extraction(lobe_time_series, THRESHOLDS, \
-                                                                     return_graph_features, return_correlations)
+    gyri_time_series_features = atlas_time_series_feature_extraction(gyri_time_series, gyri_labels, THRESHOLDS, \
+                                                                     return_graph_features, return_correlations, precision)
+    lobe_time_series_features = atlas_time_series_feature_extraction(lobe_time_series, lobe_labels, THRESHOLDS, \
+                                                                     return_graph_features, return_correlations, precision, \
+                                                                     'Brainnetome Lobe')
+    subregion_time_series_features = {}
+    if return_subregion_graph_features:
+        subregion_time_series_features = atlas_time_series_feature_extraction(time_series, subregion_labels, THRESHOLDS, \
+                                                                              True, False, precision, \
+                                                                              'Brainnetome Subregion')
     gyri_volume_features = region_feature_extraction(gyri_vol, brainnetome_gyri_vol)
     lobe_volume_features = region_feature_extraction(lobe_vol, brainnetome_lobe_vol)
-    ica_features = ICA_graph_feature_extraction(ica_time_series_file, THRESHOLDS, valid_ica_regions, return_correlations)
-    for sub_features in [gyri_time_series_features, lobe_time_series_features, gyri_volume_features, \
-                         lobe_volume_features, ica_features]:
+    ica_features = ICA_graph_feature_extraction(ica_time_series_file, THRESHOLDS, valid_ica_regions, return_correlations, precision)
+    for sub_features in [gyri_time_series_features, lobe_time_series_features, subregion_time_series_features, \
+                         gyri_volume_features, lobe_volume_features, ica_features]:
         features.update(sub_features)
     ## Write features to output in original working directory
     os.chdir(owd)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import networkx as nx
+import numpy as np
+import pytest
+
+# the scripts import their helpers as top level modules, so the tests do the same
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'feature_extraction'))
+
+
+@pytest.fixture
+def fixed_small_world(monkeypatch):
+    """
+    networkx sigma and omega generate random reference graphs, which makes them slow and different on every call, so
+    tests that compare whole feature dictionaries replace them with constants
+    """
+    monkeypatch.setattr(nx, 'sigma', lambda graph: 1.0)
+    monkeypatch.setattr(nx, 'omega', lambda graph: 1.0)
+
+
+def synthetic_time_series(n_regions, n_timepoints=490, seed=0):
+    """
+    seeded signals with shared factors, so the regions correlate the way fMRI signals do
+    :return: numpy array with one row per region and one column per time point
+    """
+    rng = np.random.default_rng(seed)
+    factors = rng.standard_normal((10, n_timepoints))
+    loadings = rng.standard_normal((n_regions, 10)) * (rng.random((n_regions, 10)) < .3)
+    return ((loadings @ factors + rng.standard_normal((n_regions, n_timepoints)) * 1.2) * 50 + 300)
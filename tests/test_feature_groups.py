@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import synthetic_time_series
+from extraction_utils import get_fingerprint, get_feature_group_fingerprints, load_feature_groups, \
+    load_region_time_series, save_feature_groups, save_region_time_series, update_feature_groups
+
+VALID_ICA_REGIONS = list(range(21))
+
+
+@pytest.fixture
+def ica_file(tmp_path):
+    ica_file = tmp_path / 'ica.txt'
+    np.savetxt(ica_file, synthetic_time_series(25, seed=1).T, delimiter='  ')
+    return (str(ica_file))
+
+
+def run_extraction(directory, ica_file, thresholds, add_correlation_features=False, precision='float64',
+                   loader_calls=None):
+    """
+    update one patient's feature groups, for the volume group, one Brainnetome level and ICA
+    :return: the stale groups that were extracted, and the features written to the features file
+    """
+    fingerprints = {'Brainnetome Volume': get_fingerprint({})}
+    fingerprints.update(get_feature_group_fingerprints('Brainnetome Lobe', thresholds, True, add_correlation_features,
+                                                       precision))
+    fingerprints.update(get_feature_group_fingerprints('ICA', thresholds, True, add_correlation_features, precision,
+                                                       VALID_ICA_REGIONS))
+    loader_calls = [] if loader_calls is None else loader_calls
+
+    def get_atlas_sources():
+        loader_calls.append('atlas')
+        return ([('Brainnetome Lobe', synthetic_time_series(7), ['Lobe ' + str(index) for index in range(7)])])
+
+    def get_volume_features():
+        loader_calls.append('volume')
+        return ({'Total Probabilistic Voxel Volume In Target Regions': np.float32(1234.5)})
+
+    directory.mkdir(exist_ok=True)
+    features_file = str(directory / 'features.json')
+    stale_groups = update_feature_groups(str(directory / 'feature_groups.json'), features_file, fingerprints, thresholds,
+                                         ica_file, VALID_ICA_REGIONS, get_atlas_sources, get_volume_features, precision)
+    with open(features_file) as data:
+        features = eval(data.read(), {'np': np, 'nan': np.nan, 'inf': np.inf})
+    return (stale_groups, features)
+
+
+def test_no_group_is_emptied_by_another_source(fixed_small_world, tmp_path, ica_file):
+    stale_groups, features = run_extraction(tmp_path, ica_file, [.25], True)
+    feature_groups = load_feature_groups(str(tmp_path / 'feature_groups.json'))
+    assert set(feature_groups) == set(stale_groups)
+    for name, feature_group in feature_groups.items():
+        assert len(feature_group['features']) > 0, name
+    assert run_extraction(tmp_path, ica_file, [.25], True)[0] == {}
+
+
+def test_added_threshold_only_extracts_its_groups(fixed_small_world, tmp_path, ica_file):
+    run_extraction(tmp_path, ica_file, [.25])
+    stale_groups, features = run_extraction(tmp_path, ica_file, [.25, .35])
+    assert set(stale_groups) == {'Brainnetome Lobe Graph at Threshold 0.35', 'ICA Graph at Threshold 0.35'}
+    full_features = run_extraction(tmp_path / 'full', ica_file, [.25, .35])[1]
+    assert features.keys() == full_features.keys()
+    for key, value in full_features.items():
+        assert features[key] == pytest.approx(value, nan_ok=True), key
+
+
+def test_correlations_only_extract_correlation_groups(fixed_small_world, tmp_path, ica_file):
+    run_extraction(tmp_path, ica_file, [.25])
+    stale_groups, features = run_extraction(tmp_path, ica_file, [.25], True)
+    assert set(stale_groups) == {'Brainnetome Lobe Correlations', 'ICA Correlations'}
+    assert any(key.startswith('Correlation ICA Regions: ') for key in features)
+
+
+def test_ica_groups_do_not_load_the_atlas(fixed_small_world, tmp_path, ica_file):
+    run_extraction(tmp_path, ica_file, [.25])
+    (tmp_path / 'features.json').unlink()
+    loader_calls = []
+    assert run_extraction(tmp_path, ica_file, [.25], loader_calls=loader_calls)[0] == {}
+    assert loader_calls == []
+    fingerprints = get_feature_group_fingerprints('ICA', [.25], True, False, 'float64', VALID_ICA_REGIONS)
+    feature_groups = load_feature_groups(str(tmp_path / 'feature_groups.json'))
+    feature_groups['ICA Graph at Threshold 0.25']['fingerprint'] = 'stale'
+    save_feature_groups(str(tmp_path / 'feature_groups.json'), feature_groups)
+    stale_groups = run_extraction(tmp_path, ica_file, [.25], loader_calls=loader_calls)[0]
+    assert stale_groups == {'ICA Graph at Threshold 0.25': fingerprints['ICA Graph at Threshold 0.25']}
+    assert loader_calls == []
+
+
+def test_removed_groups_are_dropped(fixed_small_world, tmp_path, ica_file):
+    run_extraction(tmp_path, ica_file, [.25, .35], True)
+    stale_groups, features = run_extraction(tmp_path, ica_file, [.25])
+    assert stale_groups == {}
+    feature_groups = load_feature_groups(str(tmp_path / 'feature_groups.json'))
+    assert not any(name.endswith('Correlations') or name.endswith('0.35') for name in feature_groups)
+    assert not any(key.startswith('Correlation') or key.endswith('0.35') for key in features)
+
+
+def test_float32_features_survive_json(tmp_path):
+    feature_groups_file = str(tmp_path / 'feature_groups.json')
+    values = np.array([0.1, 1234.5678, -3e-7], dtype=np.float32)
+    feature_groups = {'ICA Signal Variance': {'fingerprint': get_fingerprint({'precision': 'float32'}),
+                                              'features': {'ICA region ' + str(index) + ' Signal Variance': value
+                                                           for index, value in enumerate(values)}}}
+    save_feature_groups(feature_groups_file, feature_groups)
+    loaded = load_feature_groups(feature_groups_file)
+    assert loaded['ICA Signal Variance']['fingerprint'] == feature_groups['ICA Signal Variance']['fingerprint']
+    loaded_values = list(loaded['ICA Signal Variance']['features'].values())
+    assert np.array_equal(np.array(loaded_values, dtype=np.float32), values)
+
+
+def test_interrupted_save_keeps_the_previous_file(tmp_path, monkeypatch):
+    feature_groups_file = str(tmp_path / 'feature_groups.json')
+    feature_groups = {'ICA Signal Variance': {'fingerprint': get_fingerprint({}), 'features': {'a': 1.0}}}
+    save_feature_groups(feature_groups_file, feature_groups)
+
+    def interrupted_replace(source, destination):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, 'replace', interrupted_replace)
+    with pytest.raises(KeyboardInterrupt):
+        save_feature_groups(feature_groups_file, {'ICA Signal Variance': {'fingerprint': '', 'features': {}}})
+    assert load_feature_groups(feature_groups_file) == feature_groups
+    assert load_feature_groups(str(tmp_path / 'missing.json')) == {}
+
+
+def test_region_time_series_are_extracted_again_at_another_precision(tmp_path):
+    time_series_file = str(tmp_path / 'region_time_series.npz')
+    assert load_region_time_series(time_series_file) is None
+    time_series = synthetic_time_series(246).astype(np.float32)
+    save_region_time_series(time_series_file, time_series, 'float32')
+    loaded = load_region_time_series(time_series_file, 'float32')
+    assert loaded.dtype == np.float32 and loaded.flags['C_CONTIGUOUS']
+    assert np.array_equal(loaded, time_series)
+    assert load_region_time_series(time_series_file, 'float64') is None
@@ -0,0 +1,88 @@
+import time
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from conftest import synthetic_time_series
+from extraction_utils import MAX_EXACT_GRAPH_NODES, atlas_time_series_feature_extraction, get_average_clustering, \
+    get_average_shortest_path_length, get_global_efficiency, get_graph_statistics, get_local_efficiency, \
+    get_shortest_path_lengths, get_transitivity, get_triangles_and_degrees
+
+# measured at up to about two seconds per threshold, the bound leaves room for slower machines
+SECONDS_PER_THRESHOLD = 10
+
+
+def seeded_graphs():
+    rng = np.random.default_rng(0)
+    for n_nodes, edge_probability in [(7, .6), (21, .3), (24, .5), (40, .15), (60, .1)]:
+        for _ in range(4):
+            graph = nx.gnp_random_graph(n_nodes, edge_probability, seed=int(rng.integers(1e6)))
+            largest_component = max(nx.connected_components(graph), key=len)
+            if len(largest_component) > 3:
+                yield graph.subgraph(largest_component)
+
+
+@pytest.mark.parametrize('graph', list(seeded_graphs()))
+def test_sparse_engine_matches_networkx(graph):
+    adjacency = nx.to_scipy_sparse_array(graph, format='csr', dtype=np.float64)
+    path_lengths = get_shortest_path_lengths(adjacency)
+    triangles, degrees = get_triangles_and_degrees(adjacency)
+    assert get_local_efficiency(adjacency) == pytest.approx(nx.local_efficiency(graph), abs=1e-12)
+    assert get_global_efficiency(path_lengths) == pytest.approx(nx.global_efficiency(graph), abs=1e-12)
+    assert get_average_shortest_path_length(path_lengths) == \
+           pytest.approx(nx.average_shortest_path_length(graph), abs=1e-12)
+    assert get_average_clustering(triangles, degrees) == pytest.approx(nx.average_clustering(graph), abs=1e-12)
+    assert get_transitivity(triangles, degrees) == pytest.approx(nx.transitivity(graph), abs=1e-12)
+
+
+def test_large_graph_estimates_every_subgraph(monkeypatch):
+    def exact_small_world(graph):
+        raise AssertionError('networkx small-world reference graphs used on a subgraph of a large graph')
+    monkeypatch.setattr(nx, 'sigma', exact_small_world)
+    monkeypatch.setattr(nx, 'omega', exact_small_world)
+    monkeypatch.setattr(nx, 'average_node_connectivity', exact_small_world)
+    # a large graph that splits into components well below the exact size limit
+    graph = nx.disjoint_union_all([nx.connected_watts_strogatz_graph(30, 6, .2, seed=seed) for seed in range(8)])
+    assert len(graph.nodes) > MAX_EXACT_GRAPH_NODES
+    features = get_graph_statistics(graph)
+    assert features['Subgraphs'] == 8
+    assert features['Sigma'] > 0 and features['Omega'] != 0
+
+
+@pytest.mark.parametrize('threshold', [.25, .35])
+def test_subregion_graph_features_finish_in_seconds(threshold):
+    time_series = synthetic_time_series(246)
+    labels = ['Subregion ' + str(index) for index in range(246)]
+    start = time.time()
+    features = atlas_time_series_feature_extraction(time_series, labels, [threshold], True, False,
+                                                    graph_prefix='Brainnetome Subregion')
+    assert time.time() - start < SECONDS_PER_THRESHOLD
+    assert features['Brainnetome Subregion Average Node Connectivity at Threshold ' + str(threshold)] > 0
+
+
+@pytest.mark.parametrize('edge_probability', [.3, .5, .7])
+def test_dense_246_node_graph_finishes_in_seconds(edge_probability):
+    # subregion correlations of real data can give graphs this dense at low thresholds
+    graph = nx.gnp_random_graph(246, edge_probability, seed=1)
+    start = time.time()
+    features = get_graph_statistics(graph)
+    assert time.time() - start < SECONDS_PER_THRESHOLD
+    assert features['Average Node Connectivity'] > 0
+
+
+def test_exact_path_reports_small_world_coefficients():
+    graph = nx.connected_watts_strogatz_graph(8, 4, .2, seed=0)
+    assert len(graph.nodes) <= MAX_EXACT_GRAPH_NODES
+    features = get_graph_statistics(graph)
+    assert features['Sigma'] > 0
+    assert features['Sigma Zero Denominator'] == 0 and features['Omega Zero Denominator'] == 0
+
+
+@pytest.mark.parametrize('coefficient', [float('inf'), float('nan')])
+def test_exact_path_tallies_zero_denominators(monkeypatch, coefficient):
+    monkeypatch.setattr(nx, 'sigma', lambda graph: coefficient)
+    monkeypatch.setattr(nx, 'omega', lambda graph: coefficient)
+    features = get_graph_statistics(nx.connected_watts_strogatz_graph(8, 4, .2, seed=0))
+    assert features['Sigma'] == 0 and features['Omega'] == 0
+    assert features['Sigma Zero Denominator'] == 1 and features['Omega Zero Denominator'] == 1
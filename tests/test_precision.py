@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from config.config import regions
+from conftest import synthetic_time_series
+from extraction_utils import ICA_graph_feature_extraction, aggregate_time_series, \
+    atlas_time_series_feature_extraction, correlation_matrix
+
+# documented in config.py and the readme
+CORRELATION_TOLERANCE = 1e-5
+VARIANCE_TOLERANCE = 1e-5
+THRESHOLDS = [.25, .35]
+
+
+def assert_no_correlation_near_thresholds(corr):
+    # closer than the tolerance, float32 may flip an edge, which the documented bound allows
+    for threshold in THRESHOLDS:
+        assert np.all(np.abs(np.abs(corr) - threshold) > CORRELATION_TOLERANCE)
+
+
+def assert_features_within_tolerance(features_64, features_32):
+    assert features_64.keys() == features_32.keys()
+    for key, value_64 in features_64.items():
+        if key.startswith('Correlation'):
+            assert abs(features_32[key] - value_64) <= CORRELATION_TOLERANCE, key
+        elif key.endswith('Signal Variance'):
+            assert abs(features_32[key] - value_64) <= VARIANCE_TOLERANCE * abs(value_64), key
+        else:
+            assert features_32[key] == pytest.approx(value_64, rel=1e-9), key
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_correlations_within_absolute_tolerance(seed):
+    time_series = synthetic_time_series(246, seed=seed)
+    # centre some pairs near zero correlation, where a relative bound would not hold
+    time_series[:20] = np.random.default_rng(seed).standard_normal((20, time_series.shape[1]))
+    corr_64 = correlation_matrix(time_series, 'float64')
+    corr_32 = correlation_matrix(time_series, 'float32')
+    assert corr_32.dtype == np.float32 and corr_32.flags.c_contiguous
+    assert np.min(np.abs(corr_64)) < 1e-3
+    assert np.max(np.abs(corr_64 - corr_32)) <= CORRELATION_TOLERANCE
+
+
+def test_atlas_features_float32_within_tolerance(fixed_small_world):
+    time_series = synthetic_time_series(24)
+    labels = ['Region ' + str(index) for index in range(24)]
+    assert_no_correlation_near_thresholds(correlation_matrix(time_series))
+    features_64 = atlas_time_series_feature_extraction(time_series, labels, THRESHOLDS, True, True, 'float64')
+    features_32 = atlas_time_series_feature_extraction(time_series, labels, THRESHOLDS, True, True, 'float32')
+    assert_features_within_tolerance(features_64, features_32)
+
+
+def test_ica_features_float32_within_tolerance(fixed_small_world, tmp_path):
+    time_series = synthetic_time_series(25, seed=1)
+    assert_no_correlation_near_thresholds(correlation_matrix(time_series))
+    # UK Biobank ICA files are double space delimited, one row per time point
+    ica_file = tmp_path / 'ica.txt'
+    np.savetxt(ica_file, time_series.T, delimiter='  ')
+    valid_regions = list(range(21))
+    features_64 = ICA_graph_feature_extraction(str(ica_file), THRESHOLDS, valid_regions, True, 'float64')
+    features_32 = ICA_graph_feature_extraction(str(ica_file), THRESHOLDS, valid_regions, True, 'float32')
+    assert_features_within_tolerance(features_64, features_32)
+
+
+@pytest.mark.parametrize('group', ['Gyrus', 'Lobe'])
+def test_aggregate_time_series_matches_groupby(group):
+    time_series = synthetic_time_series(len(regions))
+    labeled_time_series = pd.concat([regions[['Lobe', 'Gyrus', 'Number']], pd.DataFrame(time_series)], axis=1)
+    other_columns = [column for column in ['Lobe', 'Gyrus', 'Number'] if column != group]
+    expected = labeled_time_series.drop(columns=other_columns).groupby([group]).mean()
+    labels, grouped = aggregate_time_series(time_series, regions[group])
+    assert labels == list(expected.index)
+    np.testing.assert_allclose(grouped, expected.to_numpy(), rtol=1e-12)